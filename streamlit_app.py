@@ -1,67 +1,132 @@
+import functools
 import json
 import streamlit as st
-# from snowflake.snowpark.context import get_active_session
-# from snowflake.snowpark.exceptions import SnowparkSQLException
-cnx = st.connection("snowflake")
-session = cnx.session()
+try:
+    import orjson
+except ImportError:
+    orjson = None
 # Config
 SEMANTIC_MODEL_PATH = "CORTEX_ANALYST.CORTEX_AI.CORTEX_ANALYST_STAGE/nlp.yaml"
 CHAT_PROCEDURE = "CORTEX_ANALYST.CORTEX_AI.CORTEX_ANALYST_CHAT_PROCEDURE"
 DREMIO_PROCEDURE = "SALESFORCE_DREMIO.SALESFORCE_SCHEMA_DREMIO.DREMIO_DATA_PROCEDURE"
+RESULT_CACHE_TTL = 600  # seconds
+RESULT_CACHE_MAX_ENTRIES = 20  # per cache; result caches are shared by every user of the process
+DISPLAY_FOLD_BLOCK = 40  # messages (20 turns); older history folds one whole block at a time
+MAX_HISTORY_TURNS = 6  # earlier user/analyst exchanges sent to Cortex Analyst with each question
+MAX_PREVIEW_ROWS = 1000  # larger results are offered as a CSV download
+
+class ProcedureError(Exception):
+    pass
+
+# orjson when available; both emit sorted keys so cache keys are stable
+if orjson is not None:
+    def json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS).decode()
+    json_loads = orjson.loads
+else:
+    def json_dumps(obj):
+        return json.dumps(obj, sort_keys=True)
+    json_loads = json.loads
 
 def initialize_session():
     if "messages" not in st.session_state:
         st.session_state.messages = []
+    if len(st.session_state.get("messages_json", ())) != len(st.session_state.messages):
+        # Rebuild from messages so the two stay index-aligned (e.g. live sessions after a redeploy)
+        st.session_state.messages_json = [json_dumps(m) for m in st.session_state.messages]
     if "display_messages" not in st.session_state:
         st.session_state.display_messages = []
     if "processing" not in st.session_state:
         st.session_state.processing = False
 
-def call_cortex_analyst_procedure(messages):
-    try:
-        messages_json = json.dumps(messages)
-        # session = get_active_session()
-        result = session.call(CHAT_PROCEDURE, messages_json, SEMANTIC_MODEL_PATH)
+@st.cache_resource(show_spinner=False)
+def get_session():
+    return st.connection("snowflake").session()
+
+def append_conversation_message(message):
+    # Encode each message once; the request body is rebuilt by joining the encoded parts
+    st.session_state.messages.append(message)
+    st.session_state.messages_json.append(json_dumps(message))
+
+def conversation_window():
+    # The current question plus the last MAX_HISTORY_TURNS exchanges (2 * N + 1 messages);
+    # the start only moves forward when failed turns left the roles out of alternation
+    messages = st.session_state.messages
+    start = max(len(messages) - (2 * MAX_HISTORY_TURNS + 1), 0)
+    while start < len(messages) - 1 and messages[start]["role"] != "user":
+        start += 1
+    return st.session_state.messages_json[start:]
+
+# Failures raise instead of returning, so st.cache_data only keeps good responses
+@st.cache_data(ttl=RESULT_CACHE_TTL, max_entries=RESULT_CACHE_MAX_ENTRIES, show_spinner=False)
+def _run_cortex_analyst(messages_json, model_path):
+    session = get_session()
+    result = session.call(CHAT_PROCEDURE, messages_json, model_path)
+
+    if not result:
+        raise ProcedureError("No response from procedure")
+
+    procedure_response = json_loads(result)
+    if not procedure_response.get("success", False):
+        raise ProcedureError(procedure_response.get("error_message", "Unknown procedure error"))
+    return procedure_response.get("content", {})
 
-        if not result:
-            return None, "No response from procedure"
+def _shrink_result(df):
+    import pandas as pd
+    # Lossless shrink of what st.dataframe ships to the browser; floats keep full precision
+    for column in df.select_dtypes("int64"):
+        df[column] = pd.to_numeric(df[column], downcast="integer")
+    for column in df.select_dtypes("object"):
+        if df[column].nunique() <= len(df) // 2:
+            df[column] = df[column].astype("category")
+    return df
 
-        procedure_response = json.loads(result)
-        if procedure_response.get("success", False):
-            return procedure_response.get("content", {}), None
-        else:
-            return None, procedure_response.get("error_message", "Unknown procedure error")
+# Returns (frame, full_csv); the CSV shares the frame's cache entry so a download always
+# matches the preview. It is only built when the preview will be truncated.
+@st.cache_data(ttl=RESULT_CACHE_TTL, max_entries=RESULT_CACHE_MAX_ENTRIES, show_spinner=False)
+def _run_dremio_query(sql_statement):
+    session = get_session()
+    df_result = session.call(DREMIO_PROCEDURE, sql_statement)
+    if not hasattr(df_result, "to_pandas"):
+        raise ProcedureError("Unexpected result format from Dremio procedure")
+    df = _shrink_result(df_result.to_pandas())
+    full_csv = df.to_csv(index=False).encode() if len(df) > MAX_PREVIEW_ROWS else None
+    return df, full_csv
 
-    except SnowparkSQLException as e:
-        return None, f"Database Error: {str(e)}"
+def _snowpark_errors(sql_error_prefix, error_prefix):
+    # Turns exceptions raised by a procedure helper into its (None, error_message) result
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            from snowflake.snowpark.exceptions import SnowparkSQLException
+            try:
+                return func(*args, **kwargs)
+            except ProcedureError as e:
+                return None, str(e)
+            except SnowparkSQLException as e:
+                return None, f"{sql_error_prefix}: {e}"
+            except Exception as e:
+                return None, f"{error_prefix}: {e}"
+        return wrapper
+    return decorator
+
+@_snowpark_errors("Database Error", "Unexpected error")
+def call_cortex_analyst_procedure(messages_json):
+    try:
+        return _run_cortex_analyst("[" + ",".join(messages_json) + "]", SEMANTIC_MODEL_PATH), None
     except json.JSONDecodeError as e:
-        return None, f"Invalid JSON response: {str(e)}"
-    except Exception as e:
-        return None, f"Unexpected error: {str(e)}"
+        return None, f"Invalid JSON response: {e}"
 
+@_snowpark_errors("Dremio SQL Error", "Dremio Error")
 def call_dremio_data_procedure(sql_statement):
-    try:
-        # session = get_active_session()
-        df_result = session.call(DREMIO_PROCEDURE, sql_statement)
-        if hasattr(df_result, "to_pandas"):
-            return df_result.to_pandas(), None
-        return None, "Unexpected result format from Dremio procedure"
-    except SnowparkSQLException as e:
-        return None, f"Dremio SQL Error: {str(e)}"
-    except Exception as e:
-        return None, f"Dremio Error: {str(e)}"
+    return _run_dremio_query(sql_statement), None
 
 def display_chat_message(role, content):
     with st.chat_message(role):
-        if isinstance(content, str):
-            st.markdown(content)
-        elif isinstance(content, dict):
-            if "message" in content:
-                st.markdown(content["message"])
-            if "query" in content:
-                st.code(content["query"], language="sql")
+        st.markdown(content)
 
 def process_user_question(question):
+    sql_display = None
     try:
         st.session_state.processing = True
 
@@ -70,7 +135,7 @@ def process_user_question(question):
             "role": "user",
             "content": [{"type": "text", "text": question}]
         }
-        st.session_state.messages.append(user_msg)
+        append_conversation_message(user_msg)
         
         # Add to display messages for UI
         st.session_state.display_messages.append({
@@ -81,8 +146,8 @@ def process_user_question(question):
         display_chat_message("user", question)
 
         with st.spinner("Analyzing your question..."):
-            # Send the full conversation history including both user and analyst messages
-            response, error = call_cortex_analyst_procedure(st.session_state.messages)
+            # Send the recent conversation history including both user and analyst messages
+            response, error = call_cortex_analyst_procedure(conversation_window())
 
             if error:
                 raise Exception(error)
@@ -94,33 +159,50 @@ def process_user_question(question):
             if not isinstance(content_block, list):
                 raise Exception("Invalid response structure from Cortex Analyst")
 
-            sql_statement = None
-            explanation = ""
-            for block in content_block:
-                if block.get("type") == "text":
-                    explanation = block.get("text", "")
-                elif block.get("type") == "sql" and "statement" in block:
-                    sql_statement = block["statement"]
-
+            sql_statement = next(
+                (block["statement"] for block in content_block
+                 if block.get("type") == "sql" and "statement" in block),
+                None
+            )
             if not sql_statement:
                 raise Exception("No SQL found in response.")
 
-            # Call Dremio
-            dremio_result, dremio_error = call_dremio_data_procedure(sql_statement)
-            if dremio_error:
-                raise Exception(dremio_error)
+            explanation = next(
+                (block.get("text", "") for block in content_block if block.get("type") == "text"),
+                ""
+            )
+
+            # Show the explanation and SQL while Dremio runs; one markdown element, updated in place
+            sql_display = f"{explanation}\n\n**Generated SQL:**\n```sql\n{sql_statement}\n```"
+            with st.chat_message("assistant"):
+                response_placeholder = st.empty()
+                response_placeholder.markdown(sql_display)
 
-            # Show response
-            display_chat_message("assistant", explanation)
-            display_chat_message("assistant", {"message": "Generated SQL:", "query": sql_statement})
+                # Call Dremio
+                dremio_output, dremio_error = call_dremio_data_procedure(sql_statement)
+                if dremio_error:
+                    raise Exception(dremio_error)
+                dremio_result, full_csv = dremio_output
 
-            if dremio_result is not None and not dremio_result.empty:
-                with st.chat_message("assistant"):
-                    st.success("✅ Dremio executed successfully")
-                    st.dataframe(dremio_result, use_container_width=True)
-                    st.caption(f"{len(dremio_result)} rows × {len(dremio_result.columns)} columns")
-            else:
-                display_chat_message("assistant", "⚠️ No data returned from Dremio.")
+                assistant_display = f"{sql_display}\n\n✅ Executed in Dremio."
+                response_placeholder.markdown(assistant_display)
+                if dremio_result is not None and not dremio_result.empty:
+                    truncated = full_csv is not None
+                    st.dataframe(dremio_result.head(MAX_PREVIEW_ROWS), use_container_width=True)
+                    st.caption(
+                        f"{len(dremio_result)} rows × {len(dremio_result.columns)} columns"
+                        + (f" (showing first {MAX_PREVIEW_ROWS})" if truncated else "")
+                    )
+                    if truncated:
+                        st.download_button(
+                            "Download full CSV",
+                            full_csv,
+                            file_name="dremio_result.csv",
+                            mime="text/csv",
+                            on_click="ignore"  # a rerun would wipe this live-only preview
+                        )
+                else:
+                    st.markdown("⚠️ No data returned from Dremio.")
 
             # CRITICAL: Add the analyst response to conversation history
             # This is required for multi-turn conversations
@@ -128,22 +210,21 @@ def process_user_question(question):
                 "role": "analyst",
                 "content": content_block  # Use the original content blocks from the API response
             }
-            st.session_state.messages.append(analyst_msg)
+            append_conversation_message(analyst_msg)
 
             # Save assistant response for display
-            assistant_display = f"{explanation}\n\n**Generated SQL:**\n```sql\n{sql_statement}\n```\n\n✅ Executed in Dremio."
             st.session_state.display_messages.append({
                 "role": "assistant",
                 "content": assistant_display
             })
 
     except Exception as e:
-        error_msg = f"❌ Error: {str(e)}"
+        error_msg = f"❌ Error: {e}"
         st.error(error_msg)
-        # Add error to display messages
+        # Add error to display messages, keeping any SQL that was already shown above it
         st.session_state.display_messages.append({
             "role": "assistant",
-            "content": error_msg
+            "content": f"{sql_display}\n\n{error_msg}" if sql_display else error_msg
         })
     finally:
         st.session_state.processing = False
@@ -152,8 +233,15 @@ def render_chat_interface():
     st.title("🧠 Cortex Analyst")
     st.caption("Ask natural questions. Get SQL + results.")
 
-    # Display messages from display_messages (for UI)
-    for msg in st.session_state.display_messages:
+    # Display messages from display_messages (for UI). Older history folds in whole blocks,
+    # keeping at least one block visible, so element positions only shift every block.
+    display_messages = st.session_state.display_messages
+    folded = max(len(display_messages) - DISPLAY_FOLD_BLOCK, 0) // DISPLAY_FOLD_BLOCK * DISPLAY_FOLD_BLOCK
+    for start in range(0, folded, DISPLAY_FOLD_BLOCK):
+        with st.expander(f"Earlier messages {start + 1}–{start + DISPLAY_FOLD_BLOCK}"):
+            for msg in display_messages[start:start + DISPLAY_FOLD_BLOCK]:
+                display_chat_message(msg["role"], msg["content"])
+    for msg in display_messages[folded:]:
         display_chat_message(msg["role"], msg["content"])
 
     if prompt := st.chat_input("Ask something...", disabled=st.session_state.processing):